@@ -2,78 +2,216 @@
 import geopandas as gpd
 import pandas as pd
 import rasterio
-from rasterstats import zonal_stats
-from shapely import wkt
-import matplotlib.pyplot as plt
+from rasterio.errors import WindowError
+from rasterio.windows import Window, from_bounds
+import shapely
+from matplotlib.figure import Figure
 import streamlit as st
 import os
 import numpy as np
 import io
+import math
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from matplotlib.colors import ListedColormap
+from matplotlib.patches import Patch
+import datashader as ds
+import datashader.transfer_functions as tf
+from preprocess_data import COG_DIR, parse_buildings_csv
 
 st.set_page_config(page_title="Khartoum Flood Dashboard", layout="wide")
 
+# GDAL block and file caches for the tiled flood masks (read from the environment,
+# so they also apply to rasters opened from worker threads).
+os.environ.setdefault("GDAL_CACHEMAX", "512")
+os.environ.setdefault("VSI_CACHE", "TRUE")
+
+# --- On-disk cache ---
+# Clipped and flooded frames are also persisted as GeoParquet, keyed on a hash of
+# their inputs, so a fresh process skips the geospatial work entirely.
+CACHE_DIR = ".cache"
+CACHE_VERSION = 3
+# Least-recently-used files are evicted once the directory grows past this size.
+CACHE_MAX_BYTES = 1024 ** 3
+
+def cache_key(*parts):
+    """Short sha256 over raw input bytes and (path, mtime)-style parts."""
+    digest = hashlib.sha256(repr(CACHE_VERSION).encode())
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else repr(part).encode())
+    return digest.hexdigest()[:16]
+
+def disk_cached(name, key, build):
+    """Read ``.cache/{name}_{key}.parquet`` if present, otherwise build the frame and store it."""
+    path = os.path.join(CACHE_DIR, f"{name}_{key}.parquet")
+    if os.path.exists(path):
+        gdf = gpd.read_parquet(path)
+        try:
+            # Refresh the mtime so eviction treats this file as recently used.
+            os.utime(path)
+        except OSError:
+            pass
+        return gdf
+    gdf = build()
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Write under a temporary name so an interrupted write never leaves a truncated cache file.
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        gdf.to_parquet(tmp_path)
+        os.replace(tmp_path, path)
+        prune_disk_cache()
+    except OSError:
+        pass
+    return gdf
+
+def prune_disk_cache(max_bytes=CACHE_MAX_BYTES):
+    """Delete the least-recently-used cache files until the directory fits in ``max_bytes``."""
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.is_file() and entry.name.endswith(".parquet"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+# --- Cached preprocessing ---
+def to_wgs84(gdf):
+    """Reproject to EPSG:4326, skipping the transform when the frame is already in it."""
+    return gdf if gdf.crs == "EPSG:4326" else gdf.to_crs("EPSG:4326")
+
+@st.cache_resource(show_spinner=False)
+def load_boundary(path, mtime):
+    return to_wgs84(gpd.read_file(path, engine="pyogrio"))
+
+def load_buildings(source):
+    """Read buildings from uploaded CSV bytes, a CSV path, or a preprocessed GeoParquet path."""
+    if isinstance(source, str) and source.endswith('.parquet'):
+        buildings_gdf = to_wgs84(gpd.read_parquet(source))
+    else:
+        buildings_gdf = parse_buildings_csv(io.BytesIO(source) if isinstance(source, bytes) else source)
+    return buildings_gdf
+
+def clip_to_boundary(buildings_gdf, khartoum_gdf):
+    """Keep the buildings that intersect the Khartoum boundary, without joining its columns.
+
+    Centroids are computed once here and kept in a ``centroid`` column for the
+    flood lookup and the centroid view.
+    """
+    khartoum_union = shapely.union_all(khartoum_gdf.geometry.values)
+    # Index the boundary's edges once; every exact test below reuses it.
+    shapely.prepare(khartoum_union)
+    if (buildings_gdf.geom_type == 'Point').all():
+        inside = shapely.intersects_xy(khartoum_union, buildings_gdf.geometry.x.values, buildings_gdf.geometry.y.values)
+        clipped = buildings_gdf[inside].copy()
+    else:
+        candidates = np.sort(buildings_gdf.sindex.query(khartoum_union))
+        hits = candidates[shapely.intersects(buildings_gdf.geometry.to_numpy()[candidates], khartoum_union)]
+        clipped = buildings_gdf.iloc[hits].copy()
+    clipped["centroid"] = clipped.geometry.centroid
+    return clipped
+
+# Inputs are passed underscore-prefixed so Streamlit skips hashing them; the
+# string disk keys already identify every input exactly. Buildings are only
+# loaded on a disk-cache miss, so a warm .cache skips parsing them entirely.
+@st.cache_resource(show_spinner=False)
+def clip_buildings(_buildings_source, _khartoum_gdf, disk_key):
+    return disk_cached("clipped", disk_key, lambda: clip_to_boundary(load_buildings(_buildings_source), _khartoum_gdf))
+
 # --- Upload custom building data ---
 uploaded_file = st.file_uploader("📤 Upload Your Building CSV", type=["csv"])
 if uploaded_file:
-    try:
-        buildings_df = pd.read_csv(uploaded_file)
-        st.success("✅ Custom building data loaded.")
-    except Exception as e:
-        st.error(f"❌ Failed to read uploaded file: {e}")
-        st.stop()
+    buildings_source = uploaded_file.getvalue()
+    buildings_key = cache_key(buildings_source)
 else:
     try:
-        buildings_df = pd.read_csv("data/buildings.csv", encoding='utf-8')
-        st.subheader("📍 Sample Building Data")
-        st.dataframe(buildings_df.head())
+        csv_path, parquet_path = "data/buildings.csv", "data/buildings.parquet"
+        buildings_path = csv_path
+        # Only trust the preprocessed GeoParquet while it is at least as new as the CSV.
+        if os.path.exists(parquet_path):
+            if not os.path.exists(csv_path) or os.path.getmtime(parquet_path) >= os.path.getmtime(csv_path):
+                buildings_path = parquet_path
+            else:
+                st.info(f"ℹ️ {csv_path} is newer than {parquet_path}; loading the CSV. Re-run `python preprocess_data.py` to refresh the GeoParquet copy.")
+        buildings_source = buildings_path
+        buildings_key = cache_key(buildings_path, os.path.getmtime(buildings_path))
     except Exception as e:
-        st.error(f"❌ Error loading buildings CSV: {e}")
+        st.error(f"❌ Error loading buildings data: {e}")
         st.stop()
 
 # --- Load Khartoum boundary ---
 try:
-    sudan_gdf = gpd.read_file("data/Khartoum.shp").to_crs("EPSG:4326")
-    khartoum_gdf = sudan_gdf.copy()
+    boundary_path = "data/Khartoum.shp"
+    khartoum_gdf = load_boundary(boundary_path, os.path.getmtime(boundary_path))
+    clipped_key = cache_key(buildings_key, boundary_path, os.path.getmtime(boundary_path))
 except Exception as e:
     st.error(f"❌ Error loading Khartoum shapefile: {e}")
     st.stop()
 
-# --- Parse and clean WKT geometry ---
-if 'geometry' in buildings_df.columns:
-    try:
-        buildings_df['geometry'] = buildings_df['geometry'].astype(str).str.strip().str.replace('"', '')
-        valid_wkt = buildings_df['geometry'].apply(lambda x: isinstance(x, str) and x.startswith(('POINT', 'POLYGON', 'MULTIPOLYGON')))
-        buildings_df = buildings_df[valid_wkt].copy()
-        buildings_df['geometry'] = buildings_df['geometry'].apply(wkt.loads)
-        buildings_gdf = gpd.GeoDataFrame(buildings_df, geometry='geometry', crs='EPSG:4326')
-    except Exception as e:
-        st.error(f"❌ Error parsing WKT geometries: {e}")
-        st.stop()
-else:
-    st.error("❌ 'geometry' column not found in buildings CSV.")
-    st.stop()
-
 # --- Clip buildings to Khartoum ---
 try:
-    buildings_in_khartoum = gpd.sjoin(buildings_gdf, khartoum_gdf, how='inner', predicate='intersects')
+    buildings_in_khartoum = clip_buildings(buildings_source, khartoum_gdf, clipped_key)
 except Exception as e:
-    st.error(f"❌ Error clipping buildings to Khartoum: {e}")
+    if uploaded_file:
+        st.error(f"❌ Failed to read uploaded file: {e}")
+    else:
+        st.error(f"❌ Error loading or clipping buildings: {e}")
     st.stop()
 
-# --- Efficient zonal stats function ---
-def get_flooded_buildings_chunked(flood_path, buildings_gdf, chunk_size=50000):
-    flooded_chunks = []
-    buildings_gdf = buildings_gdf.to_crs("EPSG:4326")
-    for i in range(0, len(buildings_gdf), chunk_size):
-        chunk = buildings_gdf.iloc[i:i+chunk_size]
+if uploaded_file:
+    st.success("✅ Custom building data loaded.")
+else:
+    st.subheader("📍 Sample Building Data")
+    st.dataframe(buildings_in_khartoum.head().drop(columns="centroid").to_wkt())
+
+# --- Raster window helper ---
+def raster_window(src, bounds):
+    """Window of ``src`` covering ``bounds`` (minx, miny, maxx, maxy), clipped to the raster extent."""
+    full = Window(0, 0, src.width, src.height)
+    if not np.all(np.isfinite(bounds)):
+        return full
+    window = from_bounds(*bounds, transform=src.transform)
+    # Cover every pixel from the one holding the start edge through the one holding the
+    # end edge, inclusive, so features exactly on maxx/miny are not cropped out.
+    col_start, row_start = math.floor(window.col_off), math.floor(window.row_off)
+    col_stop = math.floor(window.col_off + window.width) + 1
+    row_stop = math.floor(window.row_off + window.height) + 1
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start).intersection(full)
+
+# --- Flooded building detection ---
+def get_flooded_buildings(flood_path, buildings_gdf):
+    """Flag buildings whose centroid falls on a flooded (== 1) pixel of the mask.
+
+    ``buildings_gdf`` is the clipped EPSG:4326 frame; every loader already
+    returns that CRS, so no reprojection happens here.
+    """
+    with rasterio.open(flood_path) as src:
         try:
-            stats = zonal_stats(chunk, flood_path, stats=["max"], nodata=0)
-            flooded_idx = [i for i, s in enumerate(stats) if s and s.get("max") == 1]
-            flooded_chunks.append(chunk.iloc[flooded_idx])
-        except Exception as e:
-            st.warning(f"⚠️ Zonal stats failed for chunk {i}: {e}")
-    return pd.concat(flooded_chunks).to_crs("EPSG:4326") if flooded_chunks else gpd.GeoDataFrame(columns=buildings_gdf.columns)
+            window = raster_window(src, buildings_gdf.total_bounds)
+        except WindowError:
+            return buildings_gdf.iloc[:0]
+        # The mask is binary, so read it as bytes whatever the file's dtype.
+        flood_mask = src.read(1, window=window, out_dtype="uint8")
+        inverse_transform = ~src.window_transform(window)
+    centroids = buildings_gdf["centroid"]
+    cols, rows = inverse_transform * (centroids.x.values, centroids.y.values)
+    rows = np.floor(rows).astype(np.int64)
+    cols = np.floor(cols).astype(np.int64)
+    height, width = flood_mask.shape
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    flooded = np.zeros(len(buildings_gdf), dtype=bool)
+    flooded[inside] = flood_mask[rows[inside], cols[inside]] == 1
+    return buildings_gdf.iloc[np.flatnonzero(flooded)]
+
+@st.cache_resource(show_spinner=False)
+def compute_flooded(flood_path, disk_key, _buildings_gdf):
+    return disk_cached("flooded", disk_key, lambda: get_flooded_buildings(flood_path, _buildings_gdf))
 
 # --- Load flood masks by date ---
 flood_files = {
@@ -81,49 +219,117 @@ flood_files = {
 #     "2020-09-15": "data/FloodMask_2020-09-15_MNDWI.tif"
 # }
 
+def preferred_flood_mask(path):
+    """The preprocessed COG copy of ``path`` while it is at least as new as the source, else ``path``."""
+    cog_path = os.path.join(COG_DIR, os.path.basename(path))
+    if os.path.exists(cog_path) and (not os.path.exists(path) or os.path.getmtime(cog_path) >= os.path.getmtime(path)):
+        return cog_path
+    return path
+
+flood_files = {date_str: preferred_flood_mask(path) for date_str, path in flood_files.items()}
+
+# Dates are independent and mostly wait on raster IO, so process them concurrently.
+flood_futures = {}
+flood_keys = {}
+with ThreadPoolExecutor(max_workers=max(1, len(flood_files))) as executor:
+    for date_str, path in flood_files.items():
+        if os.path.exists(path):
+            flood_keys[date_str] = cache_key(clipped_key, path, os.path.getmtime(path))
+            flood_futures[date_str] = executor.submit(compute_flooded, path, flood_keys[date_str], buildings_in_khartoum)
+        else:
+            st.warning(f"📁 Flood mask not found for {date_str}: {path}")
+
 flooded_by_date = {}
-for date_str, path in flood_files.items():
-    if os.path.exists(path):
-        try:
-            flooded_by_date[date_str] = get_flooded_buildings_chunked(path, buildings_in_khartoum)
-        except Exception as e:
-            st.warning(f"⚠️ Error processing flood mask for {date_str}: {e}")
-    else:
-        st.warning(f"📁 Flood mask not found for {date_str}: {path}")
+for date_str, future in flood_futures.items():
+    try:
+        flooded_by_date[date_str] = future.result()
+    except Exception as e:
+        st.warning(f"⚠️ Error processing flood mask for {date_str}: {e}")
 
 if not flooded_by_date:
     st.warning("⚠️ No flood data available.")
     st.stop()
 
 # --- Raster plotting helper ---
-def plot_flood_raster(ax, raster_path, scale_factor=0.1):
+def plot_flood_raster(ax, raster_path, bounds, scale_factor=0.1):
     try:
+        # Serve coarse resolutions from the deepest prebuilt overview that is still fine enough.
         with rasterio.open(raster_path) as src:
+            levels = [(i, f) for i, f in enumerate(src.overviews(1)) if f * scale_factor <= 1]
+        open_options = {}
+        if levels:
+            level, factor = levels[-1]
+            open_options["OVERVIEW_LEVEL"] = level
+            scale_factor *= factor
+        with rasterio.open(raster_path, **open_options) as src:
             st.write(f"✅ Raster opened: {raster_path}")
-            new_height = int(src.height * scale_factor)
-            new_width = int(src.width * scale_factor)
+            window = raster_window(src, bounds)
+            new_height = max(1, int(window.height * scale_factor))
+            new_width = max(1, int(window.width * scale_factor))
             flood_data = src.read(
                 1,
+                window=window,
+                out_dtype="uint8",
                 out_shape=(new_height, new_width),
                 resampling=rasterio.enums.Resampling.nearest
             )
-            extent = [src.bounds.left, src.bounds.right, src.bounds.bottom, src.bounds.top]
+            left, bottom, right, top = src.window_bounds(window)
+            extent = [left, right, bottom, top]
             cmap = ListedColormap(['none', 'blue'])  # dark blue for flood
             ax.imshow(flood_data, extent=extent, cmap=cmap, vmin=0, vmax=1, alpha=0.9)
     except Exception as e:
         st.warning(f"⚠️ Could not plot flood raster: {e}")
 
+# --- Building rasterization helper ---
+def plot_buildings_shaded(ax, gdf, bounds, color, as_points=False, alpha=1.0):
+    """Rasterize buildings with datashader and draw the result as a single image."""
+    xmin, ymin, xmax, ymax = bounds
+    # Avoid a zero-width canvas when every building shares an x or y coordinate.
+    pad = 1e-6
+    cvs = ds.Canvas(plot_width=1000, plot_height=800, x_range=(xmin - pad, xmax + pad), y_range=(ymin - pad, ymax + pad))
+    # Canvas.polygons only accepts (multi)polygons, so point buildings are aggregated
+    # separately and the two counts summed on the shared canvas.
+    geom_types = gdf.geom_type.to_numpy()
+    is_point = np.ones(len(gdf), dtype=bool) if as_points else np.isin(geom_types, ["Point", "MultiPoint"])
+    is_polygon = ~is_point & np.isin(geom_types, ["Polygon", "MultiPolygon"])
+    aggs = []
+    if is_point.any():
+        xy = shapely.get_coordinates(gdf.geometry.to_numpy()[is_point])
+        points = pd.DataFrame({"x": xy[:, 0], "y": xy[:, 1]})
+        aggs.append(cvs.points(points, "x", "y", agg=ds.count()))
+    if is_polygon.any():
+        aggs.append(cvs.polygons(gdf.loc[is_polygon, ["geometry"]], geometry="geometry", agg=ds.count()))
+    if not aggs:
+        return
+    agg = aggs[0] if len(aggs) == 1 else aggs[0] + aggs[1]
+    img = tf.shade(agg, cmap=[color])
+    ax.imshow(np.asarray(img.to_pil()), extent=[xmin - pad, xmax + pad, ymin - pad, ymax + pad], alpha=alpha)
+
+# --- Download helpers ---
+# Exports are keyed on the flooded set's exact disk-cache key; the frame itself is
+# passed as ``_flooded`` so Streamlit does not hash it.
+@st.cache_data(show_spinner=False)
+def flooded_csv(_flooded, flooded_key):
+    return _flooded.drop(columns="centroid").to_csv(index=False).encode()
+
+@st.cache_data(show_spinner=False)
+def flooded_parquet(_flooded, flooded_key):
+    """GeoParquet (WKB geometry) export, much smaller and faster to build than the WKT CSV."""
+    buf = io.BytesIO()
+    _flooded.drop(columns="centroid").to_parquet(buf)
+    return buf.getvalue()
+
 # --- Streamlit UI ---
 st.title("🌊 Flood Impact on Buildings in Khartoum (Date-Specific)")
 selected_date = st.selectbox("📅 Select Flood Date", sorted(flooded_by_date.keys()))
 flooded = flooded_by_date[selected_date]
+flooded_key = flood_keys[selected_date]
 
 # 📊 Summary Metrics
 with st.expander("📊 Summary Metrics", expanded=True):
     total_buildings = len(buildings_in_khartoum)
     flooded_count = len(flooded)
     percent_affected = round((flooded_count / total_buildings) * 100, 2)
-    avg_area = buildings_in_khartoum.geometry.area.mean()
     col1, col2, col3 = st.columns(3)
     col1.metric("Total Buildings", total_buildings)
     col2.metric(f"Flooded on {selected_date}", flooded_count)
@@ -140,18 +346,23 @@ with st.expander("📈 Flood Trend", expanded=False):
 # --- View toggle ---
 view_mode = st.radio("🗺️ Select Building View Mode", ["Polygons", "Centroids"])
 if view_mode == "Centroids":
-    buildings_to_plot = buildings_in_khartoum.copy()
-    buildings_to_plot["geometry"] = buildings_to_plot.centroid
-    flooded_to_plot = flooded.copy()
-    flooded_to_plot["geometry"] = flooded_to_plot.centroid
+    buildings_to_plot = buildings_in_khartoum.set_geometry("centroid")
+    flooded_to_plot = flooded.set_geometry("centroid")
 else:
     buildings_to_plot = buildings_in_khartoum
     flooded_to_plot = flooded
 
 # --- Plotting ---
 try:
-    fig, ax = plt.subplots(figsize=(10, 8))
-    fig.patch.set_facecolor('none')
+    # Reuse one figure per session instead of building a new one on every rerun.
+    if "fig" not in st.session_state:
+        # A bare Figure (not plt.subplots) stays out of pyplot's global figure manager,
+        # so it is freed with the session and never shared across session threads.
+        st.session_state.fig = Figure(figsize=(10, 8))
+        st.session_state.ax = st.session_state.fig.subplots()
+        st.session_state.fig.patch.set_facecolor('none')
+    fig, ax = st.session_state.fig, st.session_state.ax
+    ax.clear()
 
     if not khartoum_gdf.empty:
         khartoum_gdf.plot(ax=ax, edgecolor='black', facecolor='none', linewidth=0.5)
@@ -159,30 +370,25 @@ try:
     scale_factor = st.slider("🧭 Raster Resolution", 0.05, 1.0, 0.1)
 
     if selected_date in flood_files and os.path.exists(flood_files[selected_date]):
-        plot_flood_raster(ax, flood_files[selected_date], scale_factor)
+        plot_flood_raster(ax, flood_files[selected_date], buildings_in_khartoum.total_bounds, scale_factor)
+
+    legend_handles = []
+    plot_bounds = buildings_in_khartoum.total_bounds
+    as_points = view_mode == "Centroids"
 
     if not buildings_to_plot.empty:
-        buildings_to_plot.plot(
-            ax=ax,
-            color='none',
-            edgecolor='#000000',
-            linewidth=0.1,
-            alpha=0.6,
-            label='All Buildings'
-        )
+        # Semi-transparent so the flood raster underneath stays visible.
+        plot_buildings_shaded(ax, buildings_to_plot, plot_bounds, '#000000', as_points, alpha=0.6)
+        legend_handles.append(Patch(facecolor='#000000', edgecolor='#000000', alpha=0.6, label='All Buildings'))
 
     if not flooded_to_plot.empty and flooded_to_plot.geometry.notnull().all():
-        flooded_to_plot.plot(
-            ax=ax,
-            color='red',
-            edgecolor='red',
-            linewidth=0.05,
-            label='Flooded Buildings'
-        )
+        plot_buildings_shaded(ax, flooded_to_plot, plot_bounds, 'red', as_points)
+        legend_handles.append(Patch(facecolor='red', edgecolor='red', label='Flooded Buildings'))
 
     ax.set_title(f"Flood Impact on {selected_date}", fontsize=16)
     ax.axis('off')
-    ax.legend()
+    if legend_handles:
+        ax.legend(handles=legend_handles)
     st.pyplot(fig)
 
 except Exception as e:
@@ -191,11 +397,18 @@ except Exception as e:
 # --- Optional download ---
 st.download_button(
     label=f"Download Flooded Buildings ({selected_date})",
-    data=flooded.to_csv(index=False),
+    data=flooded_csv(flooded, flooded_key),
     file_name=f"flooded_buildings_{selected_date}.csv",
     mime="text/csv"
 )
 
+st.download_button(
+    label=f"Download Flooded Buildings ({selected_date}) as GeoParquet",
+    data=flooded_parquet(flooded, flooded_key),
+    file_name=f"flooded_buildings_{selected_date}.parquet",
+    mime="application/octet-stream"
+)
+
 buf = io.BytesIO()
 fig.savefig(buf, format="png", bbox_inches="tight")
 buf.seek(0)
@@ -0,0 +1,77 @@
+"""Offline preprocessing for the dashboard's data files.
+
+Run once after adding or replacing a flood mask or the buildings CSV:
+
+    python preprocess_data.py [data/FloodMask_*.tif ...]
+
+Each flood mask is copied to ``data/cog/`` as a uint8 0/1 Cloud Optimized
+GeoTIFF (256x256 DEFLATE tiles with nearest-neighbour overviews) and
+``data/buildings.csv`` is converted to ``data/buildings.parquet``. The source
+files are left untouched; the app prefers the derived copies while they are at
+least as new as their sources.
+"""
+import glob
+import os
+import sys
+
+import geopandas as gpd
+import pandas as pd
+import rasterio
+import rasterio.shutil
+from rasterio.io import MemoryFile
+import shapely
+
+BUILDINGS_CSV = "data/buildings.csv"
+BUILDINGS_PARQUET = "data/buildings.parquet"
+COG_DIR = "data/cog"
+
+def convert_to_cog(raster_path, cog_dir=COG_DIR):
+    """Write a uint8, tiled, compressed COG copy of a flood mask into ``cog_dir``."""
+    os.makedirs(cog_dir, exist_ok=True)
+    cog_path = os.path.join(cog_dir, os.path.basename(raster_path))
+    tmp_path = cog_path + ".tmp"
+    with rasterio.open(raster_path) as src:
+        profile = src.profile
+        mask = (src.read(1) == 1).astype("uint8")
+    profile.update(driver="GTiff", dtype="uint8", count=1, nodata=None)
+    with MemoryFile() as memfile, memfile.open(**profile) as byte_mask:
+        byte_mask.write(mask, 1)
+        rasterio.shutil.copy(
+            byte_mask,
+            tmp_path,
+            driver="COG",
+            BLOCKSIZE=256,
+            COMPRESS="DEFLATE",
+            OVERVIEWS="AUTO",
+            OVERVIEW_RESAMPLING="NEAREST",
+        )
+    os.replace(tmp_path, cog_path)
+    print(f"✅ Wrote COG copy of {raster_path} to {cog_path}")
+
+def parse_buildings_csv(source):
+    """Read a buildings CSV (path or file-like) and parse its WKT ``geometry`` column.
+
+    Shared with the dashboard's loader so both paths sanitize WKT identically.
+    """
+    buildings_df = pd.read_csv(source, encoding="utf-8", engine="pyarrow")
+    if "geometry" not in buildings_df.columns:
+        raise ValueError("'geometry' column not found in buildings CSV.")
+    wkt_strings = buildings_df["geometry"].astype("string").str.strip().str.replace('"', '', regex=False)
+    supported = (wkt_strings.str.startswith("POINT", na=False) | wkt_strings.str.startswith("POLYGON", na=False)
+                 | wkt_strings.str.startswith("MULTIPOLYGON", na=False)).to_numpy(dtype=bool)
+    buildings_df = buildings_df.loc[supported]
+    geoms = shapely.from_wkt(wkt_strings[supported].to_numpy(dtype=object), on_invalid="ignore")
+    valid = ~shapely.is_empty(geoms) & shapely.is_valid(geoms)
+    return gpd.GeoDataFrame(buildings_df.loc[valid].drop(columns="geometry"), geometry=geoms[valid], crs="EPSG:4326")
+
+def convert_buildings(csv_path=BUILDINGS_CSV, parquet_path=BUILDINGS_PARQUET):
+    """Parse the buildings CSV's WKT once and store it as GeoParquet."""
+    buildings_gdf = parse_buildings_csv(csv_path)
+    buildings_gdf.to_parquet(parquet_path)
+    print(f"✅ Wrote {len(buildings_gdf)} buildings to {parquet_path}")
+
+if __name__ == "__main__":
+    for path in sys.argv[1:] or sorted(glob.glob("data/FloodMask_*.tif")):
+        convert_to_cog(path)
+    if os.path.exists(BUILDINGS_CSV):
+        convert_buildings()